@@ -6,6 +6,7 @@ given QLF device fabric dependent bitstream file.
 import argparse
 import os
 import re
+import sys
 import json
 
 from collections import OrderedDict
@@ -26,12 +27,31 @@ def make_segbit_sets(bits_by_loc):
 
     This function identifies repeating patterns that conform to this assumption
     and emits common bit patterns (a.k.a. segbits) and their offsets that
-    correspond to grid locations
+    correspond to grid locations. Segbits are emitted sorted by their offsets.
     """
 
-    # First sort all bits by their names
-    for loc in bits_by_loc.keys():
-        bits_by_loc[loc] = sorted(bits_by_loc[loc], key=lambda bit: bit[1])
+    # First sort all bits by their ids (in place), then compute the offset
+    # and the relative bit pattern of each location once. A pattern is stored
+    # as two parallel tuples (relative bit offsets, bit names). Bit ids are
+    # unique so the order is canonical and the offset is the first bit id.
+    offset_by_loc = {}
+    pattern_by_loc = {}
+    for loc, bits in bits_by_loc.items():
+        bits.sort(key=lambda bit: bit[0])
+        offset = bits[0][0]
+
+        offset_by_loc[loc] = offset
+        pattern_by_loc[loc] = (
+            tuple(bit[0] - offset for bit in bits),
+            tuple(bit[1] for bit in bits),
+        )
+
+    # Group locations by their patterns
+    locs_by_pattern = {}
+    for loc, pattern in pattern_by_loc.items():
+        if pattern not in locs_by_pattern:
+            locs_by_pattern[pattern] = []
+        locs_by_pattern[pattern].append(loc)
 
     locs = set(bits_by_loc.keys())
     segbit_sets = []
@@ -40,88 +60,150 @@ def make_segbit_sets(bits_by_loc):
 
         # Pick a seed tile to be used for segbit pattern
         seed_loc = next(iter(locs))
-        seed_bits = bits_by_loc[seed_loc]
+        seed_pattern = pattern_by_loc[seed_loc]
 
-        # Find bit offset of the seed tile
-        seed_offset = min([bit[0] for bit in seed_bits])
-        seed_segbits = [(bit[0] - seed_offset, bit[1]) for bit in seed_bits]
-
-        # Varify the segbits pattern against all tiles in the grid that do
-        # not have segbits assigned yet
-        offsets = {}
-        for loc in set(locs):
-            bits = bits_by_loc[loc]
-
-            # Compute offset and segbits
-            offset = min([bit[0] for bit in bits])
-            segbits = [(bit[0] - offset, bit[1]) for bit in bits]
-
-            # Check match and store
-            if segbits == seed_segbits:
-                offsets[loc] = offset
+        # Get all tiles in the grid that share the seed pattern. None of them
+        # can have segbits assigned yet
+        offsets = {loc: offset_by_loc[loc] for loc in locs_by_pattern[seed_pattern]}
 
         # Must have at least 1 location
         assert offsets
 
         # Remove the locations with assigned segbits and add a new segbit set
-        locs -= set(offsets.keys())
+        locs.difference_update(offsets.keys())
 
         # Make the segbit set
+        seed_segbits = list(zip(*seed_pattern))
         segbit_sets.append((seed_segbits, offsets))
-        
 
     return segbit_sets
 
 
-def parse_fabric_bitstream(xml_root):
+LOC_RE = re.compile(r"(?P<name>.+)_(?P<x>[0-9]+)__(?P<y>[0-9]+)_$")
+
+
+def parse_loc_name(inst_name):
+    """
+    Splits an instance name of the form "<name>_<x>__<y>_" into the name and
+    its grid location. Returns None if the instance name does not conform to
+    that form.
+
+    The name is split using plain string operations. The LOC_RE regex is used
+    only as a fallback when that fails so that the accepted names remain the
+    same.
+    """
+
+    if inst_name.endswith("_"):
+        left, _, y = inst_name[:-1].rpartition("__")
+        name, _, x = left.rpartition("_")
+
+        if name and x.isdigit() and x.isascii() and \
+           y.isdigit() and y.isascii():
+            return name, (int(x), int(y))
+
+    match = LOC_RE.fullmatch(inst_name)
+    if match is None:
+        return None
+
+    return match.group("name"), (int(match.group("x")), int(match.group("y")))
+
+
+def iter_fabric_bitstream(file_name):
     """
-    Parses fabric bitstream XML. Returns bits as (id, name) grouped
-    by tile / switchbox types and grid locations.
+    Iterates over bits of a fabric bitstream XML file. The file is parsed
+    incrementally and each bit element is discarded once consumed so the
+    whole XML tree is never held in memory.
     """
 
-    LOC_RE = re.compile(r"(?P<name>.+)_(?P<x>[0-9]+)__(?P<y>[0-9]+)_$")
+    context = ET.iterparse(
+        file_name,
+        events=("start", "end"),
+        remove_blank_text=True
+    )
+
+    # Get the root element
+    _, xml_root = next(context)
+    assert xml_root.tag == "fabric_bitstream", xml_root.tag
+
+    for event, xml_elem in context:
+
+        # Only consider complete top-level bit elements
+        if event != "end" or xml_elem.tag != "bit" or \
+           xml_elem.getparent() is not xml_root:
+            continue
+
+        yield xml_elem
+
+        # Free the bit and all of its preceding siblings
+        xml_elem.clear()
+        while xml_elem.getprevious() is not None:
+            del xml_root[0]
+
+
+def parse_fabric_bitstream(xml_bits):
+    """
+    Parses fabric bitstream XML bit elements. Returns bits as (id, name)
+    grouped by tile / switchbox types and grid locations.
+    """
 
     grouped_bits = {}
+    bits_by_inst = {}
 
-    for xml_bit in xml_root.findall("bit"):
+    for xml_bit in xml_bits:
 
         # FIXME: For now only "scan_chain" configuration is supported. Check
-        # if the bitstream conforms to that
-        assert not xml_bit.find("wl") and not xml_bit.find("bl") \
-               and not xml_bit.find("frame"), "Only \"scan_chain\" configuration is supported"
+        # if the bitstream conforms to that. A bit without any child elements
+        # always does so skip the lookups for it.
+        if len(xml_bit):
+            assert not xml_bit.find("wl") and not xml_bit.find("bl") \
+                   and not xml_bit.find("frame"), "Only \"scan_chain\" configuration is supported"
 
         # Get bit info
         bit_id = int(xml_bit.attrib["id"])
         feature = xml_bit.attrib["path"]
 
-        # Parse the feature name to get tile type and grid coordinates
-        parts = feature.split(".")
-        assert parts[0] == "fpga_top", feature
+        # Parse the feature name to get tile type and grid coordinates. Only
+        # the top-level and instance names need to be separated from the
+        # bit name
+        parts = feature.split(".", maxsplit=2)
+        assert len(parts) == 3 and parts[0] == "fpga_top", feature
 
-        # Get grid location
-        match = LOC_RE.fullmatch(parts[1])
-        assert match is not None, feature
+        # Get the bit list of the instance. Resolve the instance name to a
+        # tile / switchbox type and grid location only once per instance.
+        inst_bits = bits_by_inst.get(parts[1], None)
+        if inst_bits is None:
 
-        loc = (int(match.group("x")), int(match.group("y")))
-        name = match.group("name")
+            # Get grid location
+            match = parse_loc_name(parts[1])
+            assert match is not None, feature
 
-        # This bit refers to a block (tile)
-        if name.startswith("grid_"):
-            name = name.replace("grid_", "")
+            name, loc = match
 
-        # This bit refers to a routing interconnect
-        else:
-            name = name.split("_", maxsplit=1)[0]
-            assert name in ["sb", "cbx", "cby"], feature
+            # This bit refers to a block (tile)
+            if name.startswith("grid_"):
+                name = name.replace("grid_", "")
 
-        # Store the bit
-        if name not in grouped_bits:
-            grouped_bits[name] = {}
+            # This bit refers to a routing interconnect
+            else:
+                name = name.split("_", maxsplit=1)[0]
+                assert name in ["sb", "cbx", "cby"], feature
+
+            # Get the bit list
+            if name not in grouped_bits:
+                grouped_bits[name] = {}
 
-        if loc not in grouped_bits[name]:
-            grouped_bits[name][loc] = set()
+            if loc not in grouped_bits[name]:
+                grouped_bits[name][loc] = []
 
-        grouped_bits[name][loc].add((bit_id, ".".join(parts[2:])))
+            inst_bits = grouped_bits[name][loc]
+            bits_by_inst[parts[1]] = inst_bits
+
+        # Intern bit names. Identical items share the same names so this lets
+        # segbit pattern comparison resolve on identity rather than content.
+        bit_name = sys.intern(parts[2])
+
+        # Store the bit
+        inst_bits.append((bit_id, bit_name))
 
     return grouped_bits
 
@@ -151,14 +233,11 @@ def main():
 
     args = parser.parse_args()
 
-    # Read and parse the fabric bitstream XML techfile
+    # Read and parse the fabric bitstream XML techfile, group bits and
+    # features
     print("Loading fabric-dependent bitstream ...")
-    xml_tree = ET.parse(args.fabric_bitstream, ET.XMLParser(remove_blank_text=True))
-    xml_bitstream = xml_tree.getroot()
-    assert xml_bitstream is not None and xml_bitstream.tag == "fabric_bitstream"
-
-    # Parse the bitstream, group bits and features
-    grouped_bits = parse_fabric_bitstream(xml_bitstream)
+    xml_bits = iter_fabric_bitstream(args.fabric_bitstream)
+    grouped_bits = parse_fabric_bitstream(xml_bits)
 
     # Count bits
     total_bits = 0
@@ -207,17 +286,19 @@ def main():
             # Store data to be written to the main device file
             if item_type not in item_at_loc:
                 item_at_loc[item_type] = {}
+            items = item_at_loc[item_type]
 
             type = tile_type if item_type == "tile" else i
-            for loc, offset in offsets.items():                
-                assert loc not in item_at_loc[item_type], (type, loc)
-                item_at_loc[item_type][loc] = (type, offset)
+            for loc, offset in offsets.items():
+                assert loc not in items, (type, loc)
+                items[loc] = (type, offset)
 
-            # Write segbits file
+            # Write segbits file. Segbits are already sorted by offset
             fname = os.path.join(args.output_dir, "segbits_{}{}.db".format(tile_type, suffix))
             with open(fname, "w") as fp:
-                for offset, name in sorted(segbits, key=lambda s: s[0]):
-                    fp.write("{} {}\n".format(name, offset))
+                fp.writelines(
+                    "{} {}\n".format(name, offset) for offset, name in segbits
+                )
 
             # Count bits
             total_bits_unflattened += len(segbits) * len(offsets)    
@@ -239,8 +320,7 @@ def main():
         items = item_at_loc[item_type]
 
         if item_type == "tile":
-            for loc in sorted(items.keys(), key=lambda x:x[::-1]):
-                (tile_type, offset) = items[loc]
+            for loc, (tile_type, offset) in sorted(items.items(), key=lambda x:x[0][::-1]):
                 device["tiles"].append({
                     "type": tile_type,
                     "x": int(loc[0]),
@@ -249,8 +329,7 @@ def main():
                 })
 
         else:
-            for loc in sorted(items.keys(), key=lambda x:x[::-1]):
-                (variant, offset) = items[loc]
+            for loc, (variant, offset) in sorted(items.items(), key=lambda x:x[0][::-1]):
                 device["routing"].append({
                     "type": item_type,
                     "variant": int(variant),
@@ -262,7 +341,7 @@ def main():
     # Write device data
     fname = os.path.join(args.output_dir, "device.json")
     with open(fname, "w") as fp:
-        json.dump(device, fp, indent=2)
+        fp.write(json.dumps(device, indent=2))
 
 
 if __name__ == "__main__":